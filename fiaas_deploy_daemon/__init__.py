@@ -12,6 +12,8 @@ import traceback
 import pinject
 import requests
 from k8s import config as k8s_config
+from k8s.client import Client
+from requests.adapters import HTTPAdapter
 
 from .config import Configuration
 from .crd import CustomResourceDefinitionBindings, DisabledCustomResourceDefinitionBindings
@@ -28,6 +30,9 @@ from .tpr import ThirdPartyResourceBindings, DisabledThirdPartyResourceBindings
 from .usage_reporting import UsageReportingBindings
 from .web import WebBindings
 
+# Each running watch holds on to a connection, so leave room for those on top of the regular API calls
+K8S_CLIENT_POOL_MAXSIZE = 20
+
 
 class MainBindings(pinject.BindingSpec):
     def __init__(self, config):
@@ -73,10 +78,12 @@ class HealthCheck(object):
 
 class Main(object):
     @pinject.copy_args_to_internal_fields
-    def __init__(self, deployer, consumer, scheduler, webapp, config, tpr_watcher, crd_watcher, usage_reporter):
+    def __init__(self, deployer, consumer, scheduler, webapp, config, tpr_watcher, crd_watcher, usage_reporter,
+                 deployment_replica_cache):
         pass
 
     def run(self):
+        self._deployment_replica_cache.start()
         self._deployer.start()
         self._consumer.start()
         self._scheduler.start()
@@ -97,6 +104,10 @@ def init_k8s_client(config):
     if config.client_cert:
         k8s_config.cert = (config.client_cert, config.client_key)
     k8s_config.debug = config.debug
+    # All models share the session of the k8s Client, make sure it can keep enough connections alive
+    adapter = HTTPAdapter(pool_maxsize=K8S_CLIENT_POOL_MAXSIZE)
+    Client._session.mount("https://", adapter)
+    Client._session.mount("http://", adapter)
 
 
 def thread_dump_logger(log):
@@ -43,10 +43,11 @@ class MainBindings(pinject.BindingSpec):
 
 class Main(object):
     @pinject.copy_args_to_internal_fields
-    def __init__(self, deployer, scheduler, config, bootstrapper):
+    def __init__(self, deployer, scheduler, config, bootstrapper, deployment_replica_cache):
         pass
 
     def run(self):
+        self._deployment_replica_cache.start()
         self._deployer.start()
         self._scheduler.start()
         if not self._bootstrapper.run():
@@ -7,6 +7,7 @@ import pinject as pinject
 from .datadog import DataDog
 from .deployer import DeploymentDeployer
 from .prometheus import Prometheus
+from .replica_cache import DeploymentReplicaCache
 from .secrets import Secrets, KubernetesSecrets, GenericInitSecrets, StrongboxSecrets
 
 
@@ -18,4 +19,5 @@ class DeploymentBindings(pinject.BindingSpec):
         bind("generic_init_secrets", to_class=GenericInitSecrets)
         bind("strongbox_secrets", to_class=StrongboxSecrets)
         bind("deployment_secrets", to_class=Secrets)
+        bind("deployment_replica_cache", to_class=DeploymentReplicaCache)
         bind("deployment_deployer", to_class=DeploymentDeployer)
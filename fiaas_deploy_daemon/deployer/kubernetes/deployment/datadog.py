@@ -15,10 +15,7 @@ class DataDog(object):
             main_container = containers[0]
             containers.append(self._create_datadog_container(app_spec, besteffort_qos_is_required))
             # TODO: Bug in k8s library allows us to mutate the default value here, so we need to take a copy
-            env = list(main_container.env)
-            env.extend(self._get_env_vars())
-            env.sort(key=lambda x: x.name)
-            main_container.env = env
+            main_container.env = sorted(main_container.env + list(self._get_env_vars()), key=lambda x: x.name)
 
     def _create_datadog_container(self, app_spec, besteffort_qos_is_required):
         if besteffort_qos_is_required:
@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 # -*- coding: utf-8
+from __future__ import absolute_import
+
 import logging
+import operator
 import shlex
 
-from k8s.client import NotFound
+from cachetools.func import lru_cache
+from k8s.client import NotFound, ClientError
 from k8s.models.common import ObjectMeta
 from k8s.models.deployment import Deployment, DeploymentSpec, PodTemplateSpec, LabelSelector, DeploymentStrategy, \
     RollingUpdateDeployment
@@ -18,36 +22,59 @@ from fiaas_deploy_daemon.tools import merge_dicts
 
 LOG = logging.getLogger(__name__)
 
+_ENV_KEY = operator.attrgetter("name")
+_INIT_CONTAINERS_SUFFIX = "kubernetes.io/init-containers"
+_STATUS_LABEL = {"fiaas/status": "active"}
+_DELETE_BODY = {"kind": "DeleteOptions", "apiVersion": "v1", "propagationPolicy": "Foreground"}
+
 
 class DeploymentDeployer(object):
     MINIMUM_GRACE_PERIOD = 30
 
-    def __init__(self, config, datadog, prometheus, deployment_secrets):
+    def __init__(self, config, datadog, prometheus, deployment_secrets, deployment_replica_cache):
         self._datadog = datadog
         self._prometheus = prometheus
         self._secrets = deployment_secrets
+        self._replica_cache = deployment_replica_cache
         self._fiaas_env = _build_fiaas_env(config)
-        self._global_env = config.global_env
+        self._base_env_vars = sorted((EnvVar(name=name, value=value) for name, value in self._fiaas_env.items()),
+                                     key=_ENV_KEY)
+        self._global_env_vars = _build_global_env_vars(config.global_env, self._fiaas_env)
         self._lifecycle = None
         self._grace_period = self.MINIMUM_GRACE_PERIOD
-        self._use_in_memory_emptydirs = config.use_in_memory_emptydirs
+        if config.use_in_memory_emptydirs:
+            self._tmp_empty_dir_source = EmptyDirVolumeSource(medium="Memory")
+        else:
+            self._tmp_empty_dir_source = EmptyDirVolumeSource()
         if config.pre_stop_delay > 0:
             self._lifecycle = Lifecycle(preStop=Handler(
                 _exec=ExecAction(command=["sleep", str(config.pre_stop_delay)])))
             self._grace_period += config.pre_stop_delay
-        self._max_surge = config.deployment_max_surge
-        self._max_unavailable = config.deployment_max_unavailable
+        self._default_strategy = DeploymentStrategy(
+            rollingUpdate=RollingUpdateDeployment(maxUnavailable=config.deployment_max_unavailable,
+                                                  maxSurge=config.deployment_max_surge))
+        self._singleton_strategy = DeploymentStrategy(
+            rollingUpdate=RollingUpdateDeployment(maxUnavailable=1, maxSurge=0))
 
     @retry_on_upsert_conflict(max_value_seconds=5, max_tries=5)
     def deploy(self, app_spec, selector, labels, besteffort_qos_is_required):
+        try:
+            self._deploy(app_spec, selector, labels, besteffort_qos_is_required, use_cache=True)
+        except NotFound:
+            # The deployment was deleted since we last saw it. Start over without the cache, so it is created again
+            LOG.info("Deployment for %s was deleted since it was last seen, creating it again", app_spec.name)
+            self._replica_cache.discard((app_spec.namespace, app_spec.name))
+            self._deploy(app_spec, selector, labels, besteffort_qos_is_required, use_cache=False)
+
+    def _deploy(self, app_spec, selector, labels, besteffort_qos_is_required, use_cache):
         LOG.info("Creating new deployment for %s", app_spec.name)
         deployment_labels = merge_dicts(app_spec.labels.deployment, labels)
         metadata = ObjectMeta(name=app_spec.name, namespace=app_spec.namespace, labels=deployment_labels,
                               annotations=app_spec.annotations.deployment)
-        container_ports = [ContainerPort(name=port_spec.name, containerPort=port_spec.target_port) for port_spec in
-                           app_spec.ports]
+        container_ports = list(_make_container_ports(tuple((port_spec.name, port_spec.target_port)
+                                                           for port_spec in app_spec.ports)))
         env = self._make_env(app_spec)
-        pull_policy = "IfNotPresent" if (":" in app_spec.image and ":latest" not in app_spec.image) else "Always"
+        pull_policy = _pull_policy(app_spec.image)
 
         env_from = [EnvFromSource(configMapRef=ConfigMapEnvSource(name=app_spec.name, optional=True))]
         containers = [
@@ -75,55 +102,77 @@ class DeploymentDeployer(object):
                            automountServiceAccountToken=automount_service_account_token,
                            terminationGracePeriodSeconds=self._grace_period)
 
-        pod_labels = merge_dicts(app_spec.labels.pod, _add_status_label(labels))
+        pod_labels = merge_dicts(app_spec.labels.pod, labels, _STATUS_LABEL)
         pod_metadata = ObjectMeta(name=app_spec.name, namespace=app_spec.namespace, labels=pod_labels,
                                   annotations=app_spec.annotations.pod)
         pod_template_spec = PodTemplateSpec(metadata=pod_metadata, spec=pod_spec)
         replicas = app_spec.replicas
         # we must avoid that the deployment scales up to app_spec.replicas if autoscaler has set another value
         if should_have_autoscaler(app_spec):
-            try:
-                deployment = Deployment.get(app_spec.name, app_spec.namespace)
-                replicas = deployment.spec.replicas
+            current_replicas = self._current_replicas(app_spec)
+            if current_replicas is not None:
+                replicas = current_replicas
                 LOG.info("Configured replica size (%d) for deployment is being ignored, as current running replica size"
-                         " is different (%d) for %s", app_spec.replicas, deployment.spec.replicas, app_spec.name)
-            except NotFound:
-                pass
+                         " is different (%d) for %s", app_spec.replicas, current_replicas, app_spec.name)
 
-        deployment_strategy = DeploymentStrategy(
-            rollingUpdate=RollingUpdateDeployment(maxUnavailable=self._max_unavailable,
-                                                  maxSurge=self._max_surge))
         if app_spec.replicas == 1 and app_spec.singleton:
-            deployment_strategy = DeploymentStrategy(
-                rollingUpdate=RollingUpdateDeployment(maxUnavailable=1, maxSurge=0))
+            deployment_strategy = self._singleton_strategy
+        else:
+            deployment_strategy = self._default_strategy
         spec = DeploymentSpec(replicas=replicas, selector=LabelSelector(matchLabels=selector),
                               template=pod_template_spec, revisionHistoryLimit=5,
                               strategy=deployment_strategy)
 
-        deployment = Deployment.get_or_create(metadata=metadata, spec=spec)
+        if use_cache:
+            deployment = self._get_or_create(metadata, spec)
+        else:
+            deployment = Deployment.get_or_create(metadata=metadata, spec=spec)
         _clear_pod_init_container_annotations(deployment)
         self._datadog.apply(deployment, app_spec, besteffort_qos_is_required)
         self._prometheus.apply(deployment, app_spec)
         self._secrets.apply(deployment, app_spec)
-        deployment.save()
+        try:
+            deployment.save()
+        except ClientError as e:
+            if e.response.status_code == 409:
+                # Our copy was outdated, make sure the retry gets the current version from the API-server
+                self._replica_cache.discard((app_spec.namespace, app_spec.name))
+            raise
 
     def delete(self, app_spec):
         LOG.info("Deleting deployment for %s", app_spec.name)
+        self._replica_cache.discard((app_spec.namespace, app_spec.name))
         try:
-            body = {"kind": "DeleteOptions", "apiVersion": "v1", "propagationPolicy": "Foreground"}
-            Deployment.delete(app_spec.name, app_spec.namespace, body=body)
+            Deployment.delete(app_spec.name, app_spec.namespace, body=_DELETE_BODY)
         except NotFound:
             pass
 
+    def _get_or_create(self, metadata, spec):
+        cached = self._replica_cache.get_deployment((metadata.namespace, metadata.name))
+        if cached is None:
+            return Deployment.get_or_create(metadata=metadata, spec=spec)
+        # Same as Deployment.get_or_create, but starting from a copy of what we last saw instead of doing a GET
+        deployment = Deployment.from_dict(cached.as_dict())
+        kwargs = {"metadata": metadata, "spec": spec}
+        for field in Deployment._meta.fields:
+            field.set(deployment, kwargs)
+        return deployment
+
+    def _current_replicas(self, app_spec):
+        replicas = self._replica_cache.get((app_spec.namespace, app_spec.name))
+        if replicas is None:
+            # Not seen by the cache (yet), so ask the API-server directly
+            try:
+                deployment = Deployment.get(app_spec.name, app_spec.namespace)
+                replicas = deployment.spec.replicas
+            except NotFound:
+                pass
+        return replicas
+
     def _make_volumes(self, app_spec):
         volumes = []
-        volumes.append(Volume(name="{}-config".format(app_spec.name),
-                              configMap=ConfigMapVolumeSource(name=app_spec.name, optional=True)))
-        if self._use_in_memory_emptydirs:
-            empty_dir_volume_source = EmptyDirVolumeSource(medium="Memory")
-        else:
-            empty_dir_volume_source = EmptyDirVolumeSource()
-        volumes.append(Volume(name="tmp", emptyDir=empty_dir_volume_source))
+        volumes.append(_make_config_map_volume(app_spec.name))
+        volumes.append(Volume(name="tmp", emptyDir=self._tmp_empty_dir_source))
         return volumes
 
     def _make_volume_mounts(self, app_spec):
@@ -134,39 +183,15 @@ class DeploymentDeployer(object):
         return volume_mounts
 
     def _make_env(self, app_spec):
-        constants = self._fiaas_env.copy()
-        constants["ARTIFACT_NAME"] = app_spec.name
-        constants["IMAGE"] = app_spec.image
-        constants["VERSION"] = app_spec.version
-        env = [EnvVar(name=name, value=value) for name, value in constants.iteritems()]
-
-        # For backward compatibility. https://github.schibsted.io/finn/fiaas-deploy-daemon/pull/34
-        global_env = []
-        for name, value in self._global_env.iteritems():
-            if "FIAAS_{}".format(name) not in constants and name not in constants:
-                global_env.extend([EnvVar(name=name, value=value), EnvVar(name="FIAAS_{}".format(name), value=value)])
-            else:
-                LOG.warn("Reserved environment-variable: {} declared as global. Ignoring and continuing".format(name))
-        env.extend(global_env)
-
-        env.extend([
-            EnvVar(name="FIAAS_REQUESTS_CPU", valueFrom=EnvVarSource(
-                resourceFieldRef=ResourceFieldSelector(containerName=app_spec.name, resource="requests.cpu",
-                                                       divisor=1))),
-            EnvVar(name="FIAAS_REQUESTS_MEMORY", valueFrom=EnvVarSource(
-                resourceFieldRef=ResourceFieldSelector(containerName=app_spec.name, resource="requests.memory",
-                                                       divisor=1))),
-            EnvVar(name="FIAAS_LIMITS_CPU", valueFrom=EnvVarSource(
-                resourceFieldRef=ResourceFieldSelector(containerName=app_spec.name, resource="limits.cpu", divisor=1))),
-            EnvVar(name="FIAAS_LIMITS_MEMORY", valueFrom=EnvVarSource(
-                resourceFieldRef=ResourceFieldSelector(containerName=app_spec.name, resource="limits.memory",
-                                                       divisor=1))),
-            EnvVar(name="FIAAS_NAMESPACE", valueFrom=EnvVarSource(
-                fieldRef=ObjectFieldSelector(fieldPath="metadata.namespace"))),
-            EnvVar(name="FIAAS_POD_NAME", valueFrom=EnvVarSource(
-                fieldRef=ObjectFieldSelector(fieldPath="metadata.name"))),
-        ])
-        env.sort(key=lambda x: x.name)
+        # All parts are already sorted by name, so the final sort only has to merge them
+        env = self._base_env_vars + [
+            EnvVar(name="ARTIFACT_NAME", value=app_spec.name),
+            EnvVar(name="IMAGE", value=app_spec.image),
+            EnvVar(name="VERSION", value=app_spec.version),
+        ]
+        env.extend(self._global_env_vars)
+        env.extend(_make_resource_field_env(app_spec.name))
+        env.sort(key=_ENV_KEY)
         return env
 
 
@@ -175,26 +200,32 @@ def _clear_pod_init_container_annotations(deployment):
     1.6 and 1.7, those annotations take precedence over the actual initContainer element in the spec object. In order to
     ensure that any changes we make take effect, we clear the annotations.
     """
-    keys_to_clear = set()
     try:
-        if deployment.spec.template.metadata.annotations:
-            for key, _ in deployment.spec.template.metadata.annotations.items():
-                if key.endswith("kubernetes.io/init-containers"):
-                    keys_to_clear.add(key)
-            for key in keys_to_clear:
-                del deployment.spec.template.metadata.annotations[key]
+        annotations = deployment.spec.template.metadata.annotations
+        if annotations:
+            deployment.spec.template.metadata.annotations = {
+                key: value for key, value in annotations.items() if not key.endswith(_INIT_CONTAINERS_SUFFIX)
+            }
     except AttributeError:
         pass
 
 
-def _add_status_label(labels):
-    copy = labels.copy()
-    copy.update({
-        "fiaas/status": "active"
-    })
-    return copy
+@lru_cache(maxsize=1024)
+def _make_config_map_volume(name):
+    return Volume(name="{}-config".format(name), configMap=ConfigMapVolumeSource(name=name, optional=True))
+
 
+@lru_cache(maxsize=4096)
+def _pull_policy(image):
+    return "IfNotPresent" if (":" in image and ":latest" not in image) else "Always"
 
+
+@lru_cache(maxsize=512)
+def _make_container_ports(ports):
+    return tuple(ContainerPort(name=name, containerPort=target_port) for name, target_port in ports)
+
+
+@lru_cache(maxsize=512)
 def _make_resource_requirements(resources_spec):
     def as_dict(resource_requirement_spec):
         return {"cpu": resource_requirement_spec.cpu, "memory": resource_requirement_spec.memory}
@@ -203,23 +234,34 @@ def _make_resource_requirements(resources_spec):
 
 
 def _make_probe(check_spec):
-    probe = Probe(initialDelaySeconds=check_spec.initial_delay_seconds,
-                  timeoutSeconds=check_spec.timeout_seconds,
-                  successThreshold=check_spec.success_threshold,
-                  failureThreshold=check_spec.failure_threshold,
-                  periodSeconds=check_spec.period_seconds)
+    # Pass the action to the constructor, as assigning it afterwards compares and merges with the default value
     if check_spec.http:
-        probe.httpGet = HTTPGetAction(path=check_spec.http.path, port=check_spec.http.port,
-                                      httpHeaders=[HTTPHeader(name=name, value=value)
-                                                   for name, value in check_spec.http.http_headers.items()])
+        action = {"httpGet": HTTPGetAction(path=check_spec.http.path, port=check_spec.http.port,
+                                           httpHeaders=_make_http_headers(check_spec.http.http_headers))}
     elif check_spec.tcp:
-        probe.tcpSocket = TCPSocketAction(port=check_spec.tcp.port)
+        action = {"tcpSocket": TCPSocketAction(port=check_spec.tcp.port)}
     elif check_spec.execute:
-        probe._exec = ExecAction(command=shlex.split(check_spec.execute.command))
+        action = {"_exec": ExecAction(command=list(_split_command(check_spec.execute.command)))}
     else:
         raise RuntimeError("AppSpec must have exactly one health check, none was defined.")
 
-    return probe
+    return Probe(initialDelaySeconds=check_spec.initial_delay_seconds,
+                 timeoutSeconds=check_spec.timeout_seconds,
+                 successThreshold=check_spec.success_threshold,
+                 failureThreshold=check_spec.failure_threshold,
+                 periodSeconds=check_spec.period_seconds,
+                 **action)
+
+
+def _make_http_headers(http_headers):
+    if not http_headers:
+        return []
+    return [HTTPHeader(name=name, value=value) for name, value in http_headers.items()]
+
+
+@lru_cache(maxsize=256)
+def _split_command(command):
+    return tuple(shlex.split(command))
 
 
 def _build_fiaas_env(config):
@@ -236,3 +278,44 @@ def _build_fiaas_env(config):
             "CONSTRETTO_TAGS": ",".join(("kubernetes-{}".format(config.environment), "kubernetes", config.environment)),
         })
     return env
+
+
+def _build_global_env_vars(global_env, fiaas_env):
+    # For backward compatibility. https://github.schibsted.io/finn/fiaas-deploy-daemon/pull/34
+    reserved = frozenset(fiaas_env) | {"ARTIFACT_NAME", "IMAGE", "VERSION"}
+    env = []
+    for name, value in global_env.items():
+        prefixed = "FIAAS_" + name
+        if prefixed in reserved or name in reserved:
+            LOG.warn("Reserved environment-variable: {} declared as global. Ignoring and continuing".format(name))
+            continue
+        env.append(EnvVar(name=name, value=value))
+        env.append(EnvVar(name=prefixed, value=value))
+    env.sort(key=_ENV_KEY)
+    return env
+
+
+_FIAAS_NAMESPACE_ENV = EnvVar(name="FIAAS_NAMESPACE", valueFrom=EnvVarSource(
+    fieldRef=ObjectFieldSelector(fieldPath="metadata.namespace")))
+_FIAAS_POD_NAME_ENV = EnvVar(name="FIAAS_POD_NAME", valueFrom=EnvVarSource(
+    fieldRef=ObjectFieldSelector(fieldPath="metadata.name")))
+
+
+@lru_cache(maxsize=1024)
+def _make_resource_field_env(container_name):
+    # Keep sorted by name
+    return (
+        EnvVar(name="FIAAS_LIMITS_CPU", valueFrom=EnvVarSource(
+            resourceFieldRef=ResourceFieldSelector(containerName=container_name, resource="limits.cpu", divisor=1))),
+        EnvVar(name="FIAAS_LIMITS_MEMORY", valueFrom=EnvVarSource(
+            resourceFieldRef=ResourceFieldSelector(containerName=container_name, resource="limits.memory",
+                                                   divisor=1))),
+        _FIAAS_NAMESPACE_ENV,
+        _FIAAS_POD_NAME_ENV,
+        EnvVar(name="FIAAS_REQUESTS_CPU", valueFrom=EnvVarSource(
+            resourceFieldRef=ResourceFieldSelector(containerName=container_name, resource="requests.cpu",
+                                                   divisor=1))),
+        EnvVar(name="FIAAS_REQUESTS_MEMORY", valueFrom=EnvVarSource(
+            resourceFieldRef=ResourceFieldSelector(containerName=container_name, resource="requests.memory",
+                                                   divisor=1))),
+    )
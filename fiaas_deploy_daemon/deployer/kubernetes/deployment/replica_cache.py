@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+from __future__ import absolute_import
+
+import json
+import logging
+
+from k8s.base import WatchEvent
+from k8s.models.deployment import Deployment
+
+from ....base_thread import DaemonThread
+
+LOG = logging.getLogger(__name__)
+
+# Have the API-server end each watch after this many seconds, so we reconnect regularly
+_WATCH_TIMEOUT_SECONDS = 300
+# If the API-server hasn't closed the connection some time after that, the connection has silently died
+_WATCH_READ_TIMEOUT = _WATCH_TIMEOUT_SECONDS + 30
+
+
+class DeploymentReplicaCache(DaemonThread):
+    """Keep track of the current state of all deployments, using a LIST+WATCH against the API-server
+
+    The DeploymentDeployer needs the current replica count for applications with an autoscaler, so that a deploy
+    doesn't override whatever the autoscaler has decided, and the current resourceVersion in order to update the
+    deployment. Watching for changes lets us avoid a GET on every deploy.
+    """
+
+    def __init__(self, config):
+        super(DeploymentReplicaCache, self).__init__()
+        self._deployments = {}
+        if config.enable_deprecated_multi_namespace_support:
+            self._namespace = None
+        else:
+            self._namespace = config.namespace
+
+    def __call__(self):
+        while True:
+            self._watch()
+
+    def get(self, key, default=None):
+        """Look up the replica count for the deployment identified by the (namespace, name) tuple `key`"""
+        deployment = self._deployments.get(key)
+        if deployment is None:
+            return default
+        return deployment.spec.replicas
+
+    def get_deployment(self, key):
+        """Look up the last seen Deployment identified by the (namespace, name) tuple `key`
+
+        The returned object is shared, and must not be modified.
+        """
+        return self._deployments.get(key)
+
+    def discard(self, key):
+        """Forget the deployment identified by `key`, until the next watch event for it arrives"""
+        self._deployments.pop(key, None)
+
+    def _watch(self):
+        try:
+            for event in _watch_deployments(self._namespace):
+                self._handle_watch_event(event)
+        except Exception:
+            LOG.exception("Error while watching for changes on Deployments")
+        # We can't know what happened while we were disconnected, so start fresh on the next connection
+        self._deployments.clear()
+
+    def _handle_watch_event(self, event):
+        key = (event.object.metadata.namespace, event.object.metadata.name)
+        if event.type in (WatchEvent.ADDED, WatchEvent.MODIFIED):
+            self._deployments[key] = event.object
+        elif event.type == WatchEvent.DELETED:
+            self._deployments.pop(key, None)
+        else:
+            raise ValueError("Unknown WatchEvent type {}".format(event.type))
+
+
+def _watch_deployments(namespace):
+    """Yield WatchEvents for Deployments, until the API-server closes the connection or it times out
+
+    The Deployment model in the k8s library has no watch_list_url, so we ask for a watch on the list URL instead.
+    """
+    if namespace is None:
+        url = Deployment._meta.list_url
+    else:
+        url = Deployment._meta.url_template.format(namespace=namespace, name="")
+    params = {"watch": "true", "timeoutSeconds": _WATCH_TIMEOUT_SECONDS}
+    resp = Deployment._client.get(url, params=params, stream=True, timeout=_WATCH_READ_TIMEOUT)
+    for line in resp.iter_lines(chunk_size=None):
+        if line:
+            try:
+                yield WatchEvent(json.loads(line), Deployment)
+            except ValueError:
+                LOG.exception("Unable to parse JSON on watch event, discarding event. Line: %r", line)
@@ -46,16 +46,11 @@ class KubernetesSecrets(object):
         self._apply_volumes(app_spec, pod_spec)
 
     def _apply_volumes(self, app_spec, pod_spec):
-        volumes = []
-        volumes.extend(self._make_volumes(app_spec))
-        volumes.extend(pod_spec.volumes)
-        pod_spec.volumes = volumes
+        pod_spec.volumes = self._make_volumes(app_spec) + pod_spec.volumes
 
     def _apply_mounts(self, app_spec, main_container):
-        volume_mounts = []
-        volume_mounts.extend(self._make_volume_mounts(app_spec, is_init_container=False))
-        volume_mounts.extend(main_container.volumeMounts)
-        main_container.volumeMounts = volume_mounts
+        main_container.volumeMounts = self._make_volume_mounts(app_spec, is_init_container=False) + \
+            main_container.volumeMounts
 
     def _make_volumes(self, app_spec):
         volumes = [
@@ -78,7 +73,10 @@ class GenericInitSecrets(KubernetesSecrets):
     def __init__(self, config):
         self._secrets_init_container_image = config.secrets_init_container_image
         self._secrets_service_account_name = config.secrets_service_account_name
-        self._use_in_memory_emptydirs = config.use_in_memory_emptydirs
+        if config.use_in_memory_emptydirs:
+            self._empty_dir_volume_source = EmptyDirVolumeSource(medium="Memory")
+        else:
+            self._empty_dir_volume_source = EmptyDirVolumeSource()
 
     def apply(self, deployment, app_spec):
         deployment_spec = deployment.spec
@@ -100,12 +98,8 @@ class GenericInitSecrets(KubernetesSecrets):
         self._apply_volumes(app_spec, pod_spec)
 
     def _make_volumes(self, app_spec):
-        if self._use_in_memory_emptydirs:
-            empty_dir_volume_source = EmptyDirVolumeSource(medium="Memory")
-        else:
-            empty_dir_volume_source = EmptyDirVolumeSource()
         volumes = [
-            Volume(name="{}-secret".format(app_spec.name), emptyDir=empty_dir_volume_source),
+            Volume(name="{}-secret".format(app_spec.name), emptyDir=self._empty_dir_volume_source),
             Volume(name="{}-config".format(self.SECRETS_INIT_CONTAINER_NAME),
                    configMap=ConfigMapVolumeSource(name=self.SECRETS_INIT_CONTAINER_NAME, optional=True)),
         ]
@@ -1,4 +1,4 @@
-import yaml
+from ..tools import safe_load_yaml
 
 
 class AppConfigDownloader(object):
@@ -9,5 +9,5 @@ class AppConfigDownloader(object):
     def get(self, fiaas_url):
         resp = self._session.get(fiaas_url, timeout=self._timeout_seconds)
         resp.raise_for_status()
-        app_config = yaml.safe_load(resp.text)
+        app_config = safe_load_yaml(resp.text)
         return app_config
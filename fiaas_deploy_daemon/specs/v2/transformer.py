@@ -5,10 +5,9 @@ from __future__ import absolute_import, unicode_literals
 import collections
 import pkgutil
 
-import yaml
-
 from ..lookup import LookupMapping
 from ..factory import BaseTransformer, InvalidConfiguration
+from ...tools import safe_load_yaml
 
 
 RESOURCE_UNDEFINED_UGLYHACK = object()
@@ -33,7 +32,7 @@ class Transformer(BaseTransformer):
     }
 
     def __init__(self):
-        self._defaults = yaml.safe_load(pkgutil.get_data("fiaas_deploy_daemon.specs.v2", "defaults.yml"))
+        self._defaults = safe_load_yaml(pkgutil.get_data("fiaas_deploy_daemon.specs.v2", "defaults.yml"))
 
     def __call__(self, app_config, strip_defaults=False):
         lookup = LookupMapping(app_config, self._defaults)
@@ -74,7 +73,7 @@ class Transformer(BaseTransformer):
         return new_config
 
     def _strip_v3_defaults(self, app_config):
-        v3defaults = yaml.safe_load(pkgutil.get_data("fiaas_deploy_daemon.specs.v3", "defaults.yml"))
+        v3defaults = safe_load_yaml(pkgutil.get_data("fiaas_deploy_daemon.specs.v3", "defaults.yml"))
 
         try:
             for requirement_type in ("limits", "requests"):
@@ -4,21 +4,20 @@ from __future__ import absolute_import, unicode_literals
 
 import pkgutil
 
-import yaml
-
 from ..factory import BaseFactory, InvalidConfiguration
 from ..lookup import LookupMapping
 from ..models import AppSpec, PrometheusSpec, DatadogSpec, ResourcesSpec, ResourceRequirementSpec, PortSpec, \
     HealthCheckSpec, CheckSpec, HttpCheckSpec, TcpCheckSpec, ExecCheckSpec, AutoscalerSpec, \
     LabelAndAnnotationSpec, IngressItemSpec, IngressPathMappingSpec, StrongboxSpec, IngressTlsSpec
 from ..v2.transformer import RESOURCE_UNDEFINED_UGLYHACK
+from ...tools import safe_load_yaml
 
 
 class Factory(BaseFactory):
     version = 3
 
     def __init__(self, config=None):
-        self._defaults = yaml.safe_load(pkgutil.get_data("fiaas_deploy_daemon.specs.v3", "defaults.yml"))
+        self._defaults = safe_load_yaml(pkgutil.get_data("fiaas_deploy_daemon.specs.v3", "defaults.yml"))
         # Overwrite default value based on config flag for ingress_tls
         self._defaults["extensions"]["tls"]["enabled"] = config and config.use_ingress_tls == "default_on"
 
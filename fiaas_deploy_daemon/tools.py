@@ -5,9 +5,15 @@ import logging
 from Queue import Queue
 from collections import Iterator
 
+import yaml
 from k8s import config
 from requests_toolbelt.utils.dump import dump_all
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 
 def merge_dicts(*args):
     result = {}
@@ -16,6 +22,11 @@ def merge_dicts(*args):
     return result
 
 
+def safe_load_yaml(stream):
+    """Same as yaml.safe_load, but uses the much faster libyaml based loader when PyYAML is built with it"""
+    return yaml.load(stream, Loader=SafeLoader)
+
+
 def log_request_response(resp, *args, **kwargs):
     if resp.url.startswith(config.api_server):
         return  # k8s library already does its own dumping, we don't need to do it here
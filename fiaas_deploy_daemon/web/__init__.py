@@ -6,7 +6,6 @@ import logging
 import pkgutil
 
 import pinject
-import yaml
 from flask import Flask, Blueprint, current_app, render_template, make_response, request_started, request_finished, \
     got_request_exception, abort, request
 from flask_talisman import Talisman, DENY
@@ -14,6 +13,7 @@ from prometheus_client import generate_latest, CONTENT_TYPE_LATEST, Counter, His
 
 from .transformer import Transformer
 from ..specs.factory import InvalidConfiguration
+from ..tools import safe_load_yaml
 
 """Web app that provides metrics and other ways to inspect the action.
 Also, endpoints to manually generate AppSpecs and send to deployer for when no pipeline exists.
@@ -74,7 +74,7 @@ def transform():
     if request.method == 'GET':
         return render_template("transform.html")
     elif request.method == 'POST':
-        return _transform(yaml.safe_load(request.get_data()))
+        return _transform(safe_load_yaml(request.get_data()))
 
 
 def _transform(app_config):
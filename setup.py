@@ -24,6 +24,7 @@ GENERIC_REQ = [
     "appdirs == 1.4.3",
     "requests-toolbelt == 0.8.0",
     "backoff == 1.6",
+    "cachetools == 2.0.1",
 ]
 
 WEB_REQ = [
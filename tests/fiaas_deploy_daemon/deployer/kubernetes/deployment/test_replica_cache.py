@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+import json
+
+import mock
+import pytest
+from k8s.base import WatchEvent
+from k8s.models.deployment import Deployment
+from requests import Response
+
+from fiaas_deploy_daemon.config import Configuration
+from fiaas_deploy_daemon.deployer.kubernetes.deployment.replica_cache import DeploymentReplicaCache
+
+
+def _event(event_type, name, replicas):
+    return json.dumps({
+        "type": event_type,
+        "object": {
+            "metadata": {"name": name, "namespace": "default"},
+            "spec": {"replicas": replicas},
+        }
+    })
+
+
+class TestDeploymentReplicaCache(object):
+    @pytest.fixture
+    def config(self):
+        config = mock.create_autospec(Configuration([]), spec_set=True)
+        config.namespace = "default"
+        config.enable_deprecated_multi_namespace_support = False
+        return config
+
+    @pytest.fixture
+    def replica_cache(self, config):
+        return DeploymentReplicaCache(config)
+
+    @pytest.fixture
+    def watch_response(self, get):
+        response = mock.create_autospec(Response)
+        get.side_effect = None
+        get.return_value = response
+        return response
+
+    def test_tracks_replicas_from_watch_events(self, replica_cache):
+        for event_type, name, replicas in ((WatchEvent.ADDED, "first", 2),
+                                           (WatchEvent.ADDED, "second", 3),
+                                           (WatchEvent.MODIFIED, "first", 5),
+                                           (WatchEvent.DELETED, "second", 3)):
+            replica_cache._handle_watch_event(WatchEvent(json.loads(_event(event_type, name, replicas)), Deployment))
+
+        assert replica_cache.get(("default", "first")) == 5
+        assert replica_cache.get(("default", "second")) is None
+
+    def test_watches_namespace(self, replica_cache, get, watch_response):
+        watch_response.iter_lines.return_value = ["", _event(WatchEvent.ADDED, "first", 2)]
+
+        with mock.patch.object(replica_cache, "_handle_watch_event") as handle_watch_event:
+            replica_cache._watch()
+
+        get.assert_called_once_with("/apis/extensions/v1beta1/namespaces/default/deployments/",
+                                    params={"watch": "true", "timeoutSeconds": 300}, stream=True, timeout=330)
+        handle_watch_event.assert_called_once()
+
+    def test_watches_all_namespaces_when_multi_namespace_support_is_enabled(self, config, get, watch_response):
+        config.enable_deprecated_multi_namespace_support = True
+        watch_response.iter_lines.return_value = []
+
+        DeploymentReplicaCache(config)._watch()
+
+        get.assert_called_once_with("/apis/extensions/v1beta1/deployments",
+                                    params={"watch": "true", "timeoutSeconds": 300}, stream=True, timeout=330)
+
+    def test_cache_is_cleared_when_watch_ends(self, replica_cache, watch_response):
+        watch_response.iter_lines.side_effect = [[_event(WatchEvent.ADDED, "first", 2)], []]
+
+        replica_cache._watch()
+
+        assert replica_cache.get(("default", "first")) is None
+
+    def test_get_returns_default_on_miss(self, replica_cache):
+        assert replica_cache.get(("default", "unknown"), 4) == 4
+        assert replica_cache.get_deployment(("default", "unknown")) is None
+
+    def test_discard(self, replica_cache):
+        replica_cache._handle_watch_event(WatchEvent(json.loads(_event(WatchEvent.ADDED, "first", 2)), Deployment))
+        assert replica_cache.get_deployment(("default", "first")).metadata.name == "first"
+
+        replica_cache.discard(("default", "first"))
+
+        assert replica_cache.get_deployment(("default", "first")) is None
@@ -4,15 +4,19 @@ from collections import defaultdict
 
 import mock
 import pytest
+from k8s.client import ClientError, NotFound
 from k8s.models.deployment import Deployment
 from mock import create_autospec
 from requests import Response
 
 from fiaas_deploy_daemon.config import Configuration
 from fiaas_deploy_daemon.deployer.kubernetes.deployment import DeploymentDeployer, DataDog, Prometheus, Secrets
-from fiaas_deploy_daemon.deployer.kubernetes.deployment.deployer import _make_probe
+from fiaas_deploy_daemon.deployer.kubernetes.deployment.deployer import _make_probe, _pull_policy
+from fiaas_deploy_daemon.deployer.kubernetes.deployment.secrets import KubernetesSecrets
+from fiaas_deploy_daemon.deployer.kubernetes.deployment.replica_cache import DeploymentReplicaCache
+from fiaas_deploy_daemon.retry import UpsertConflict
 from fiaas_deploy_daemon.specs.models import CheckSpec, HttpCheckSpec, TcpCheckSpec, AutoscalerSpec, \
-    ResourceRequirementSpec, ResourcesSpec, ExecCheckSpec, HealthCheckSpec, LabelAndAnnotationSpec
+    ResourceRequirementSpec, ResourcesSpec, ExecCheckSpec, HealthCheckSpec, LabelAndAnnotationSpec, DatadogSpec
 from fiaas_deploy_daemon.tools import merge_dicts
 
 SELECTOR = {'app': 'testapp'}
@@ -49,6 +53,20 @@ def test_make_tcp_probe():
     assert probe.timeoutSeconds == 10
 
 
+def test_make_exec_probe():
+    check_spec = CheckSpec(execute=ExecCheckSpec(command="/app/check.sh --verbose"), http=None, tcp=None,
+                           initial_delay_seconds=30, period_seconds=60, success_threshold=3, failure_threshold=3,
+                           timeout_seconds=10)
+    probe = _make_probe(check_spec)
+    assert probe._exec.command == ["/app/check.sh", "--verbose"]
+    assert probe.httpGet.as_dict() is None
+    assert probe.tcpSocket.as_dict() is None
+    assert probe.initialDelaySeconds == 30
+    assert probe.periodSeconds == 60
+    assert probe.successThreshold == 3
+    assert probe.timeoutSeconds == 10
+
+
 def test_make_probe_should_fail_when_no_healthcheck_is_defined():
     check_spec = CheckSpec(tcp=None, execute=None, http=None, initial_delay_seconds=30, period_seconds=60,
                            success_threshold=3, failure_threshold=3, timeout_seconds=10)
@@ -56,6 +74,17 @@ def test_make_probe_should_fail_when_no_healthcheck_is_defined():
         _make_probe(check_spec)
 
 
+@pytest.mark.parametrize("image,expected", (
+        ("finntech/testimage:version", "IfNotPresent"),
+        ("finntech/testimage:latest", "Always"),
+        ("finntech/testimage:latest-rc1", "Always"),
+        ("finntech/testimage", "Always"),
+        ("registry:5000/testimage:version", "IfNotPresent"),
+))
+def test_pull_policy(image, expected):
+    assert _pull_policy(image) == expected
+
+
 class TestDeploymentDeployer(object):
     @pytest.fixture(params=(
             None,
@@ -133,15 +162,22 @@ class TestDeploymentDeployer(object):
     def secrets(self, config):
         return mock.create_autospec(Secrets(config, None, None, None), spec_set=True, instance=True)
 
+    @pytest.fixture
+    def replica_cache(self):
+        replica_cache = mock.create_autospec(DeploymentReplicaCache, spec_set=True, instance=True)
+        replica_cache.get.return_value = None
+        replica_cache.get_deployment.return_value = None
+        return replica_cache
+
     @pytest.mark.usefixtures("get")
-    def test_deploy_new_deployment(self, post, config, app_spec, datadog, prometheus, secrets):
+    def test_deploy_new_deployment(self, post, config, app_spec, datadog, prometheus, secrets, replica_cache):
         expected_deployment = create_expected_deployment(config, app_spec)
         mock_response = create_autospec(Response)
         mock_response.json.return_value = expected_deployment
         post.side_effect = None
         post.return_value = mock_response
 
-        deployer = DeploymentDeployer(config, datadog, prometheus, secrets)
+        deployer = DeploymentDeployer(config, datadog, prometheus, secrets, replica_cache)
         deployer.deploy(app_spec, SELECTOR, LABELS, False)
 
         pytest.helpers.assert_any_call(post, DEPLOYMENTS_URI, expected_deployment)
@@ -149,7 +185,8 @@ class TestDeploymentDeployer(object):
         prometheus.apply.assert_called_once_with(DeploymentMatcher(), app_spec)
         secrets.apply.assert_called_once_with(DeploymentMatcher(), app_spec)
 
-    def test_deploy_clears_alpha_beta_annotations(self, put, get, config, app_spec, datadog, prometheus, secrets):
+    def test_deploy_clears_alpha_beta_annotations(self, put, get, config, app_spec, datadog, prometheus, secrets,
+                                                  replica_cache):
         old_strongbox_spec = app_spec.strongbox._replace(enabled=True, groups=["group1", "group2"])
         old_app_spec = app_spec._replace(replicas=10, strongbox=old_strongbox_spec)
         old_deployment = create_expected_deployment(config, old_app_spec, add_init_container_annotations=True)
@@ -164,7 +201,7 @@ class TestDeploymentDeployer(object):
         put.side_effect = None
         put.return_value = put_mock_response
 
-        deployer = DeploymentDeployer(config, datadog, prometheus, secrets)
+        deployer = DeploymentDeployer(config, datadog, prometheus, secrets, replica_cache)
         deployer.deploy(app_spec, SELECTOR, LABELS, False)
 
         pytest.helpers.assert_any_call(put, DEPLOYMENTS_URI + "testapp", expected_deployment)
@@ -178,8 +215,8 @@ class TestDeploymentDeployer(object):
     ))
     def test_replicas_when_autoscaler_enabled(self, previous_replicas, max_replicas, min_replicas, cpu_request,
                                               expected_replicas, config, app_spec, get, put, post, datadog, prometheus,
-                                              secrets):
-        deployer = DeploymentDeployer(config, datadog, prometheus, secrets)
+                                              secrets, replica_cache):
+        deployer = DeploymentDeployer(config, datadog, prometheus, secrets, replica_cache)
 
         image = "finntech/testimage:version2"
         version = "version2"
@@ -283,6 +320,102 @@ class TestDeploymentDeployer(object):
         prometheus.apply.assert_called_once_with(DeploymentMatcher(), app_spec)
         secrets.apply.assert_called_once_with(DeploymentMatcher(), app_spec)
 
+    @pytest.mark.usefixtures("get")
+    def test_replicas_from_cache_when_autoscaler_enabled(self, config, app_spec, post, datadog, prometheus, secrets,
+                                                         replica_cache):
+        app_spec = app_spec._replace(
+            replicas=3,
+            autoscaler=AutoscalerSpec(enabled=True, min_replicas=2, cpu_threshold_percentage=50),
+            resources=ResourcesSpec(requests=ResourceRequirementSpec(cpu="1", memory=None),
+                                    limits=ResourceRequirementSpec(cpu=None, memory=None)))
+        replica_cache.get.return_value = 7
+
+        expected_deployment = create_expected_deployment(config, app_spec, replicas=7)
+        mock_response = create_autospec(Response)
+        mock_response.json.return_value = expected_deployment
+        post.side_effect = None
+        post.return_value = mock_response
+
+        deployer = DeploymentDeployer(config, datadog, prometheus, secrets, replica_cache)
+        deployer.deploy(app_spec, SELECTOR, LABELS, False)
+
+        replica_cache.get.assert_called_once_with(("default", "testapp"))
+        pytest.helpers.assert_any_call(post, DEPLOYMENTS_URI, expected_deployment)
+
+    def test_update_cached_deployment_without_get(self, config, app_spec, get, put, datadog, prometheus, secrets,
+                                                  replica_cache):
+        old_deployment = create_expected_deployment(config, app_spec._replace(replicas=10))
+        old_deployment["metadata"]["resourceVersion"] = "1234"
+        # status is reset just like Deployment.get_or_create does, so it isn't sent back to the API-server
+        old_deployment["status"] = {"replicas": 10, "availableReplicas": 10, "observedGeneration": 3}
+        replica_cache.get_deployment.return_value = Deployment.from_dict(old_deployment)
+
+        expected_deployment = create_expected_deployment(config, app_spec)
+        expected_deployment["metadata"]["resourceVersion"] = "1234"
+        put_mock_response = create_autospec(Response)
+        put_mock_response.json.return_value = expected_deployment
+        put.side_effect = None
+        put.return_value = put_mock_response
+
+        deployer = DeploymentDeployer(config, datadog, prometheus, secrets, replica_cache)
+        deployer.deploy(app_spec, SELECTOR, LABELS, False)
+
+        pytest.helpers.assert_no_calls(get)
+        pytest.helpers.assert_any_call(put, DEPLOYMENTS_URI + "testapp", expected_deployment)
+        replica_cache.get_deployment.assert_called_once_with(("default", "testapp"))
+
+    def test_discard_cached_deployment_on_conflict(self, config, app_spec, get, put, datadog, prometheus, secrets,
+                                                   replica_cache):
+        old_deployment = create_expected_deployment(config, app_spec)
+        old_deployment["metadata"]["resourceVersion"] = "1234"
+        replica_cache.get_deployment.return_value = Deployment.from_dict(old_deployment)
+        conflict_response = create_autospec(Response)
+        conflict_response.status_code = 409
+        conflict_response.json.return_value = {"reason": "Conflict", "message": "outdated"}
+        put.side_effect = ClientError("Conflict", response=conflict_response)
+
+        deployer = DeploymentDeployer(config, datadog, prometheus, secrets, replica_cache)
+        with mock.patch("backoff._sync.time.sleep"), pytest.raises(UpsertConflict):
+            deployer.deploy(app_spec, SELECTOR, LABELS, False)
+
+        replica_cache.discard.assert_called_with(("default", "testapp"))
+
+    def test_recreate_cached_deployment_deleted_since_last_seen(self, config, app_spec, get, put, post, prometheus,
+                                                                replica_cache):
+        app_spec = app_spec._replace(datadog=DatadogSpec(enabled=True, tags={}), secrets_in_environment=True)
+        config.datadog_container_image = "DATADOG_IMAGE"
+        config.secrets_init_container_image = None
+        config.strongbox_init_container_image = None
+        old_deployment = create_expected_deployment(config, app_spec)
+        old_deployment["metadata"]["resourceVersion"] = "1234"
+        replica_cache.get_deployment.return_value = Deployment.from_dict(old_deployment)
+        put.side_effect = NotFound()
+        post_mock_response = create_autospec(Response)
+        post_mock_response.json.return_value = create_expected_deployment(config, app_spec)
+        post.side_effect = None
+        post.return_value = post_mock_response
+
+        # Real mutators, to catch anything being applied twice when starting over
+        secrets = Secrets(config, KubernetesSecrets(), None, None)
+        deployer = DeploymentDeployer(config, DataDog(config), prometheus, secrets, replica_cache)
+        deployer.deploy(app_spec, SELECTOR, LABELS, False)
+
+        replica_cache.discard.assert_called_once_with(("default", "testapp"))
+        post.assert_called_once()
+        url, body = post.call_args[0]
+        assert url == DEPLOYMENTS_URI
+        assert "resourceVersion" not in body["metadata"]
+        pod_spec = body["spec"]["template"]["spec"]
+        assert [c["name"] for c in pod_spec["containers"]] == ["testapp", "fiaas-datadog-container"]
+        main_container = pod_spec["containers"][0]
+        env_names = [e["name"] for e in main_container["env"]]
+        assert len(env_names) == len(set(env_names))
+        assert len([e for e in main_container["envFrom"] if "secretRef" in e]) == 1
+        mount_names = [m["name"] for m in main_container["volumeMounts"]]
+        assert len(mount_names) == len(set(mount_names))
+        volume_names = [v["name"] for v in pod_spec["volumes"]]
+        assert len(volume_names) == len(set(volume_names))
+
 
 def create_expected_deployment(config,
                                app_spec,
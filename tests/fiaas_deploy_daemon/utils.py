@@ -1,9 +1,10 @@
 from __future__ import print_function
 
-import contextlib
-from copy import deepcopy
 from datetime import datetime
-from distutils.version import StrictVersion
+import itertools
+import json
+from multiprocessing.pool import ThreadPool
+import os
 import re
 import socket
 import sys
@@ -11,62 +12,112 @@ import time
 import traceback
 from urlparse import urljoin
 
+from cachetools.func import lru_cache
 from k8s.models.autoscaler import HorizontalPodAutoscaler
 from k8s.models.deployment import Deployment
 from k8s.models.service import Service
 from monotonic import monotonic as time_monotonic
 import pytest
 import requests
-import yaml
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 
 from fiaas_deploy_daemon.crd.types import FiaasApplication, FiaasApplicationStatus
+from fiaas_deploy_daemon.tools import safe_load_yaml
 from fiaas_deploy_daemon.tpr.types import PaasbetaApplication, PaasbetaStatus
 
+# Sessions shared by the availability checks, keyed by the certificates used to talk to the cluster
+_SESSIONS = {}
+_SESSION_RETRIES = 3
+# Created on first use, so that importing these helpers doesn't start threads
+_PROBE_POOL = None
+
+_INVALID_NAME_CHARS = re.compile(r"[^-a-z0-9]")
+
 
 def plog(message):
     """Primitive logging"""
     print("%s: %s" % (time.asctime(), message), file=sys.stderr)  # noqa: T001
 
 
-def wait_until(action, description=None, exception_class=AssertionError, patience=30):
-    """Attempt to call 'action' every 2 seconds, until it completes without exception or patience runs out"""
+def wait_until(action, description=None, exception_class=AssertionError, patience=30, backoff_cap=2):
+    """Attempt to call 'action' until it completes without exception or patience runs out
+
+    The delay between attempts starts small and grows exponentially, up to 'backoff_cap' seconds.
+    """
     __tracebackhide__ = True
 
-    start = time_monotonic()
-    cause = []
+    deadline = time_monotonic() + patience
+    delay = 0.05
+    exc_info = None
     if not description:
         description = action.__doc__ or action.__name__
     message = []
-    while time_monotonic() < (start + patience):
+    while time_monotonic() < deadline:
         try:
             action()
             return
-        except BaseException:
-            cause = traceback.format_exception(*sys.exc_info())
-        time.sleep(2)
-    if cause:
+        # pytest.fail (and a failing pytest.raises) raise an exception that doesn't inherit from Exception
+        except (Exception, pytest.fail.Exception):
+            exc_info = sys.exc_info()
+        time.sleep(max(0, min(delay, deadline - time_monotonic())))
+        delay = min(delay * 1.5, backoff_cap)
+    if exc_info:
         message.append("\nThe last exception was:\n")
-        message.extend(cause)
+        message.extend(traceback.format_exception(*exc_info))
     header = "Gave up waiting for {} after {} seconds at {}".format(description, patience, datetime.now().isoformat(" "))
     message.insert(0, header)
     raise exception_class("".join(message))
 
 
+def _session(kubernetes):
+    key = (kubernetes["api-cert"], kubernetes["client-cert"], kubernetes["client-key"])
+    try:
+        return _SESSIONS[key]
+    except KeyError:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=Retry(total=_SESSION_RETRIES, backoff_factor=0.2))
+        session.mount("https://", adapter)
+        session.verify = kubernetes["api-cert"]
+        session.cert = (kubernetes["client-cert"], kubernetes["client-key"])
+        _SESSIONS[key] = session
+        return session
+
+
+def _probe_pool():
+    global _PROBE_POOL
+    if _PROBE_POOL is None:
+        _PROBE_POOL = ThreadPool(2)
+    return _PROBE_POOL
+
+
+def _check_available(session, urls, timeout):
+    """Request all urls concurrently, raising if any of them fail"""
+    def _check(url):
+        plog("Checking %s" % url)
+        resp = session.get(url, timeout=timeout, stream=True)
+        if not resp.ok:
+            # Error bodies are small, and consuming them lets the connection go back to the pool for the next attempt
+            resp.content
+            resp.raise_for_status()
+        # Only the status code matters, so close without downloading the list
+        resp.close()
+        plog("!!!!! %s is available !!!!" % url)
+
+    # A wait without timeout can't be interrupted by Ctrl-C on Python 2, so bound it by the request timeout, allowing
+    # for the retries done by the session
+    _probe_pool().map_async(_check, urls).get(timeout * (1 + _SESSION_RETRIES) + 2)
+
+
 def tpr_available(kubernetes, timeout=5):
     app_url = urljoin(kubernetes["server"], PaasbetaApplication._meta.url_template.format(namespace="default", name=""))
     status_url = urljoin(kubernetes["server"], PaasbetaStatus._meta.url_template.format(namespace="default", name=""))
-    session = requests.Session()
-    session.verify = kubernetes["api-cert"]
-    session.cert = (kubernetes["client-cert"], kubernetes["client-key"])
+    session = _session(kubernetes)
 
     def _tpr_available():
         plog("Checking if TPRs are available")
-        for url in (app_url, status_url):
-            plog("Checking %s" % url)
-            resp = session.get(url, timeout=timeout)
-            resp.raise_for_status()
-            plog("!!!!! %s is available !!!!" % url)
+        _check_available(session, (app_url, status_url), timeout)
 
     return _tpr_available
 
@@ -74,27 +125,28 @@ def tpr_available(kubernetes, timeout=5):
 def crd_available(kubernetes, timeout=5):
     app_url = urljoin(kubernetes["server"], FiaasApplication._meta.url_template.format(namespace="default", name=""))
     status_url = urljoin(kubernetes["server"], FiaasApplicationStatus._meta.url_template.format(namespace="default", name=""))
-    session = requests.Session()
-    session.verify = kubernetes["api-cert"]
-    session.cert = (kubernetes["client-cert"], kubernetes["client-key"])
+    session = _session(kubernetes)
 
     def _crd_available():
         plog("Checking if CRDs are available")
-        for url in (app_url, status_url):
-            plog("Checking %s" % url)
-            resp = session.get(url, timeout=timeout)
-            resp.raise_for_status()
-            plog("!!!!! %s is available !!!!" % url)
+        _check_available(session, (app_url, status_url), timeout)
 
     return _crd_available
 
 
+@lru_cache(maxsize=32)
+def _parse_k8s_version(k8s_version):
+    """Turn a version like v1.9.0 into a tuple of ints, padded to three elements so that v1.7 == v1.7.0"""
+    parts = tuple(int(part) for part in k8s_version.lstrip("v").split(".")[:3])
+    return parts + (0,) * (3 - len(parts))
+
+
 def tpr_supported(k8s_version):
-    return StrictVersion("1.6.0") <= StrictVersion(k8s_version[1:]) < StrictVersion("1.8.0")
+    return (1, 6, 0) <= _parse_k8s_version(k8s_version) < (1, 8, 0)
 
 
 def crd_supported(k8s_version):
-    return StrictVersion("1.7.0") <= StrictVersion(k8s_version[1:])
+    return (1, 7, 0) <= _parse_k8s_version(k8s_version)
 
 
 def skip_if_tpr_not_supported(k8s_version):
@@ -108,27 +160,87 @@ def skip_if_crd_not_supported(k8s_version):
 
 
 def read_yml(yml_path):
-    with open(yml_path, 'r') as fobj:
-        yml = yaml.safe_load(fobj)
-    return yml
+    """Parse the YAML file at `yml_path`
+
+    Parsed files are cached until they are modified, and each caller gets its own copy to modify as it sees fit.
+    """
+    yml_path = os.path.abspath(yml_path)
+    return _copy_json(_read_yml(yml_path, os.path.getmtime(yml_path)))
+
+
+def _copy_json(data):
+    """Deep copy plain JSON-compatible data, like parsed manifests, faster than copy.deepcopy"""
+    return json.loads(json.dumps(data))
+
+
+@lru_cache(maxsize=256)
+def _read_yml(yml_path, mtime):
+    with open(yml_path, 'rb') as fobj:
+        data = fobj.read()
+    return safe_load_yaml(data)
 
 
 def sanitize_resource_name(yml_path):
     """must match the regex [a-z]([-a-z0-9]*[a-z0-9])?"""
-    return re.sub("[^-a-z0-9]", "-", yml_path.replace(".yml", ""))
+    if yml_path.endswith(".yml"):
+        yml_path = yml_path[:-len(".yml")]
+    return _INVALID_NAME_CHARS.sub("-", yml_path)
+
+
+# auto-generated k8s fields that we can't control in test data and/or don't care about testing
+_GENERATED_KEYS = (
+    ("metadata", "creationTimestamp"),  # the time at which the resource was created
+    # indicates how many times the resource has been modified
+    ("metadata", "generation"),
+    # resourceVersion is used to handle concurrent updates to the same resource
+    ("metadata", "resourceVersion"),
+    ("metadata", "selfLink"),  # a API link to the resource itself
+    # a unique id randomly for the resource generated on the Kubernetes side
+    ("metadata", "uid"),
+    # an internal annotation used to track ReplicaSets tied to a particular version of a Deployment
+    ("metadata", "annotations", "deployment.kubernetes.io/revision"),
+    # status is managed by Kubernetes itself, and is not part of the configuration of the resource
+    ("status",),
+)
+
+# auto-generated k8s fields that only occur on some kinds of resources
+_GENERATED_KEYS_BY_TYPE = {
+    # autoscaling.alpha.kubernetes.io/conditions is automatically set when converting from
+    # autoscaling/v2beta.HorizontalPodAutoscaler to autoscaling/v1.HorizontalPodAutoscaler internally in Kubernetes
+    HorizontalPodAutoscaler: (
+        ("metadata", "annotations", "autoscaling.alpha.kubernetes.io/conditions"),
+    ),
+    # pod.alpha.kubernetes.io/init-containers
+    # pod.beta.kubernetes.io/init-containers
+    # pod.alpha.kubernetes.io/init-container-statuses
+    # pod.beta.kubernetes.io/init-container-statuses
+    # are automatically set when converting from core.Pod to v1.Pod internally in Kubernetes (in some versions)
+    Deployment: (
+        ("spec", "template", "metadata", "annotations", "pod.alpha.kubernetes.io/init-containers"),
+        ("spec", "template", "metadata", "annotations", "pod.beta.kubernetes.io/init-containers"),
+        ("spec", "template", "metadata", "annotations", "pod.alpha.kubernetes.io/init-container-statuses"),
+        ("spec", "template", "metadata", "annotations", "pod.beta.kubernetes.io/init-container-statuses"),
+    ),
+    Service: (
+        ("spec", "clusterIP"),  # an available ip is picked randomly
+    ),
+}
 
 
 def assert_k8s_resource_matches(resource, expected_dict, image, service_type, deployment_id, strongbox_groups):
-    actual_dict = deepcopy(resource.as_dict())
-    expected_dict = deepcopy(expected_dict)
+    # as_dict builds a new structure on every call, so it is safe to modify
+    actual_dict = resource.as_dict()
+    # expected_dict is reused for several assertions in the same test, so work on a copy
+    expected_dict = _copy_json(expected_dict)
 
     # set expected test parameters
-    _set_labels(expected_dict, image, deployment_id)
+    version = image.rsplit(":", 1)[-1]
+    _set_labels(expected_dict, version, deployment_id)
 
     if expected_dict["kind"] == "Deployment":
         _set_image(expected_dict, image)
-        _set_env(expected_dict, image)
-        _set_labels(expected_dict["spec"]["template"], image, deployment_id)
+        _set_env(expected_dict, image, version)
+        _set_labels(expected_dict["spec"]["template"], version, deployment_id)
         if strongbox_groups:
             _set_strongbox_groups(expected_dict, strongbox_groups)
 
@@ -139,35 +251,9 @@ def assert_k8s_resource_matches(resource, expected_dict, image, service_type, de
     del expected_dict['apiVersion']
     del expected_dict['kind']
 
-    # delete auto-generated k8s fields that we can't control in test data and/or don't care about testing
-    _ensure_key_missing(actual_dict, "metadata", "creationTimestamp")  # the time at which the resource was created
-    # indicates how many times the resource has been modified
-    _ensure_key_missing(actual_dict, "metadata", "generation")
-    # resourceVersion is used to handle concurrent updates to the same resource
-    _ensure_key_missing(actual_dict, "metadata", "resourceVersion")
-    _ensure_key_missing(actual_dict, "metadata", "selfLink")   # a API link to the resource itself
-    # a unique id randomly for the resource generated on the Kubernetes side
-    _ensure_key_missing(actual_dict, "metadata", "uid")
-    # an internal annotation used to track ReplicaSets tied to a particular version of a Deployment
-    _ensure_key_missing(actual_dict, "metadata", "annotations", "deployment.kubernetes.io/revision")
-    # status is managed by Kubernetes itself, and is not part of the configuration of the resource
-    _ensure_key_missing(actual_dict, "status")
-    # autoscaling.alpha.kubernetes.io/conditions is automatically set when converting from
-    # autoscaling/v2beta.HorizontalPodAutoscaler to autoscaling/v1.HorizontalPodAutoscaler internally in Kubernetes
-    if isinstance(resource, HorizontalPodAutoscaler):
-        _ensure_key_missing(actual_dict, "metadata", "annotations", "autoscaling.alpha.kubernetes.io/conditions")
-    # pod.alpha.kubernetes.io/init-containers
-    # pod.beta.kubernetes.io/init-containers
-    # pod.alpha.kubernetes.io/init-container-statuses
-    # pod.beta.kubernetes.io/init-container-statuses
-    # are automatically set when converting from core.Pod to v1.Pod internally in Kubernetes (in some versions)
-    if isinstance(resource, Deployment):
-        _ensure_key_missing(actual_dict, "spec", "template", "metadata", "annotations", "pod.alpha.kubernetes.io/init-containers")
-        _ensure_key_missing(actual_dict, "spec", "template", "metadata", "annotations", "pod.beta.kubernetes.io/init-containers")
-        _ensure_key_missing(actual_dict, "spec", "template", "metadata", "annotations", "pod.alpha.kubernetes.io/init-container-statuses")
-        _ensure_key_missing(actual_dict, "spec", "template", "metadata", "annotations", "pod.beta.kubernetes.io/init-container-statuses")
+    for keys in _GENERATED_KEYS + _GENERATED_KEYS_BY_TYPE.get(type(resource), ()):
+        _ensure_key_missing(actual_dict, *keys)
     if isinstance(resource, Service):
-        _ensure_key_missing(actual_dict, "spec", "clusterIP")  # an available ip is picked randomly
         for port in actual_dict["spec"]["ports"]:
             _ensure_key_missing(port, "nodePort")  # an available port is randomly picked from the nodePort range
 
@@ -178,28 +264,22 @@ def _set_image(expected_dict, image):
     expected_dict["spec"]["template"]["spec"]["containers"][0]["image"] = image
 
 
-def _set_env(expected_dict, image):
-    def generate_updated_env():
-        for item in expected_dict["spec"]["template"]["spec"]["containers"][0]["env"]:
-            if item["name"] == "VERSION":
-                item["value"] = image.split(":")[-1]
-            if item["name"] == "IMAGE":
-                item["value"] = image
-            yield item
-    expected_dict["spec"]["template"]["spec"]["containers"][0]["env"] = list(generate_updated_env())
+def _set_env(expected_dict, image, version):
+    for item in expected_dict["spec"]["template"]["spec"]["containers"][0]["env"]:
+        if item["name"] == "VERSION":
+            item["value"] = version
+        elif item["name"] == "IMAGE":
+            item["value"] = image
 
 
 def _set_strongbox_groups(expected_dict, strongbox_groups):
-    def generate_updated_env():
-        for item in expected_dict["spec"]["template"]["spec"]["initContainers"][0]["env"]:
-            if item["name"] == "SECRET_GROUPS":
-                item["value"] = ",".join(strongbox_groups)
-            yield item
-    expected_dict["spec"]["template"]["spec"]["initContainers"][0]["env"] = list(generate_updated_env())
+    for item in expected_dict["spec"]["template"]["spec"]["initContainers"][0]["env"]:
+        if item["name"] == "SECRET_GROUPS":
+            item["value"] = ",".join(strongbox_groups)
 
 
-def _set_labels(expected_dict, image, deployment_id):
-    expected_dict["metadata"]["labels"]["fiaas/version"] = image.split(":")[-1]
+def _set_labels(expected_dict, version, deployment_id):
+    expected_dict["metadata"]["labels"]["fiaas/version"] = version
     expected_dict["metadata"]["labels"]["fiaas/deployment_id"] = deployment_id
 
 
@@ -208,14 +288,11 @@ def _set_service_type(expected_dict, service_type):
 
 
 def _ensure_key_missing(d, *keys):
-    key = keys[0]
-    try:
-        if len(keys) > 1:
-            _ensure_key_missing(d[key], *keys[1:])
-        else:
-            del d[key]
-    except KeyError:
-        pass  # key was already missing
+    for key in keys[:-1]:
+        d = d.get(key)
+        if d is None:
+            return  # key was already missing
+    d.pop(keys[-1], None)
 
 
 def configure_mock_fail_then_success(mockk, fail=None, success=None, fail_times=1):
@@ -224,21 +301,30 @@ def configure_mock_fail_then_success(mockk, fail=None, success=None, fail_times=
     if success is None:
         success = lambda *args, **kwargs: None  # noqa: E731
 
-    def _function_generator():
-        for _ in range(fail_times):
-            yield fail
-        while True:
-            yield success
-
-    gen = _function_generator()
+    functions = itertools.chain(itertools.repeat(fail, fail_times), itertools.repeat(success))
 
     def _function():
-        return next(gen)()
+        return next(functions)()
 
     mockk.side_effect = _function
 
 
 def get_unbound_port():
-    with contextlib.closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
-        s.bind(("", 0))
-        return s.getsockname()[1]
+    return get_unbound_ports(1)[0]
+
+
+def get_unbound_ports(n):
+    """Find n distinct ports that are currently unbound
+
+    All the sockets are kept open until every port has been picked, so the OS can't hand out the same port twice.
+    """
+    sockets = []
+    try:
+        for _ in range(n):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sockets.append(sock)
+            sock.bind(("", 0))
+        return [bound.getsockname()[1] for bound in sockets]
+    finally:
+        for sock in sockets:
+            sock.close()